@@ -0,0 +1,83 @@
+""" Cold-start budget check for the chtc-log-tools CLI.
+
+Runs cheap CLI invocations in fresh interpreters and exits non-zero if any of them imports a
+dependency that it shouldn't need (i.e. top-level --help importing subcommands' dependencies).
+The least CPU time each takes over that of a bare `import typer` is reported too, but only for
+reference, as it varies too much from run to run to fail on. Queries are always run locally,
+never through a query daemon.
+
+    python benchmarks/startup_budget.py [--runs N]
+"""
+import os
+import sys
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+
+CLI_SOURCE = Path(__file__).resolve().parent.parent / "src" / "log_tools"
+
+# Dependencies that should only be imported once a subcommand is invoked
+SUBCOMMAND_ONLY_MODULES = {"rapidfuzz", "thefuzz", "tabulate", "magic", "pytz", "dotenv", "msgspec"}
+# Dependencies that should only be imported once a query needs them (i.e. fuzzy filtering)
+QUERY_ONLY_MODULES = {"rapidfuzz", "thefuzz"}
+
+# Invocation -> modules it must not import
+FORBIDDEN_IMPORTS = {
+    ("--help",): SUBCOMMAND_ONLY_MODULES,
+    ("times", "--help"): QUERY_ONLY_MODULES,
+    ("filter", "--help"): QUERY_ONLY_MODULES,
+}
+
+
+def run_cli(args: list[str], *flags: str) -> subprocess.CompletedProcess:
+    return run_python([*flags, str(CLI_SOURCE), *args])
+
+
+def run_python(args: list[str]) -> subprocess.CompletedProcess:
+    env = {**os.environ, "LOG_TOOLS_SOCKET": ""}
+    return subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True)
+
+
+def least_cpu_ms(args: list[str], runs: int) -> float:
+    """ Least CPU (user + system) time taken by the Python interpreter run with the given
+    arguments, which is much less sensitive to other load on the machine than wall time
+    """
+    times = []
+    for _ in range(runs):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result = run_python(args)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        times.append((after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime) * 1000)
+        if result.returncode != 0:
+            sys.exit(f"'{' '.join(args)}' failed:\n{result.stderr}")
+    return min(times)
+
+
+def imported_modules(args: list[str]) -> set[str]:
+    """ Top-level names of every module imported by an invocation, via -X importtime """
+    stderr = run_cli(args, "-X", "importtime").stderr
+    return {line.rsplit("|", 1)[-1].strip().split(".")[0] for line in stderr.splitlines() if line.startswith("import time:")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="Interpreter launches per invocation")
+    opts = parser.parse_args()
+
+    baseline = least_cpu_ms(["-c", "import typer"], opts.runs)
+    print(f"      {'import typer':15} {baseline:7.1f} ms")
+
+    failed = False
+    for args, forbidden in FORBIDDEN_IMPORTS.items():
+        elapsed = least_cpu_ms([str(CLI_SOURCE), *args], opts.runs) - baseline
+        eager = imported_modules(list(args)) & forbidden
+        failed |= bool(eager)
+        imports = f"  imports {', '.join(sorted(eager))}" if eager else ""
+        print(f"{'FAIL' if eager else 'ok':4}  {' '.join(args):15} {elapsed:+7.1f} ms{imports}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
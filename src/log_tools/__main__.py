@@ -8,5 +8,5 @@ if not __package__:
     sys.path.insert(0, package_source_path)
 
 if __name__ == "__main__":
-    from log_tools.cli import app
-    app()
\ No newline at end of file
+    from log_tools.client import main
+    main()
\ No newline at end of file
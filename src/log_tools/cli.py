@@ -1,16 +1,55 @@
+import importlib
 import typer
+from typer.core import TyperGroup, TyperCommand
+from functools import cached_property
 
-from .sequence_check import sequence
-from .log_tools import filterer
-from .partition_checker import partition_checker
-from .stats import stats
 
+# Subcommands, mapped to the module and Typer app implementing them along with their short help,
+# so that only the invoked subcommand (and its dependencies) need to be imported
+SUBCOMMANDS = {
+    "filter": ("log_tools", "filterer", "Print log messages matching a set of filters and date ranges"),
+    "times": ("partition_checker", "partition_checker", "Find the time ranges for which log partitions have records"),
+    "stats": ("stats", "stats", "Tabulate the count of matching filters in log messages across a partition key"),
+    "compact": ("compactor", "compactor", "Merge each partition's log files for a day into a single seekable file"),
+    "serve": ("daemon", "daemon", "Run a resident query daemon on a local Unix socket"),
+}
 
-app = typer.Typer()
-app.add_typer(filterer, name="filter")
-app.add_typer(partition_checker, name="times")
-app.add_typer(stats, name="stats")
 
+class LazySubcommand(TyperCommand):
+    """ Stand-in for a subcommand that imports its implementing module only once it is invoked,
+    handing parsing and invocation over to the real command
+    """
+    def __init__(self, name: str, module: str, attr: str, help: str):
+        super().__init__(name, help=help, add_help_option=False)
+        self.module = module
+        self.attr = attr
+
+    @cached_property
+    def command(self) -> TyperGroup:
+        sub_app = getattr(importlib.import_module(f".{self.module}", __package__), self.attr)
+        return typer.main.get_group(sub_app)
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        # The returned context belongs to the real command, which the parent group invokes
+        return self.command.make_context(info_name, args, parent=parent, **extra)
+
+
+class LazyGroup(TyperGroup):
+    def list_commands(self, ctx):
+        return list(SUBCOMMANDS)
+
+    def get_command(self, ctx, name):
+        if name not in SUBCOMMANDS:
+            return None
+        return LazySubcommand(name, *SUBCOMMANDS[name])
+
+
+app = typer.Typer(cls=LazyGroup)
+
+@app.callback()
+def log_tools():
+    """ Tools for querying structured logs collected by fluentd
+    """
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+import os
+import sys
+import stat
+import json
+import socket
+import struct
+
+# Subcommands that are answered by a running `chtc-log-tools serve` daemon when one is available
+DAEMON_COMMANDS = {"filter", "stats", "times"}
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", f"chtc-log-tools-{os.getuid()}.sock")
+
+# Daemon responses are a stream of [kind, length, payload] frames, ending with an exit code frame
+FRAME_HEADER = struct.Struct("!cI")
+STDOUT_FRAME = b"o"
+STDERR_FRAME = b"e"
+EXIT_FRAME = b"x"
+
+
+def send_frame(sock: socket.socket, kind: bytes, payload: bytes):
+    sock.sendall(FRAME_HEADER.pack(kind, len(payload)) + payload)
+
+
+def run_remote(argv: list[str]) -> int | None:
+    """ Run a CLI invocation on the query daemon, relaying its output to this process's
+    stdout/stderr. Returns the invocation's exit code, or None if no daemon of this user's is
+    listening on LOG_TOOLS_SOCKET (set it to an empty string to always run queries locally)
+    """
+    socket_path = os.environ.get("LOG_TOOLS_SOCKET", DEFAULT_SOCKET)
+    if not socket_path:
+        return None
+    try:
+        st = os.stat(socket_path)
+    except OSError:
+        return None
+    # Queries are sent along with their environment, so only to a socket this user created
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # Stale socket left behind by a daemon that is no longer running
+        sock.close()
+        return None
+
+    request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ), "tty": sys.stdout.isatty()}
+    with sock, sock.makefile("rb") as response:
+        sock.sendall(json.dumps(request).encode())
+        sock.shutdown(socket.SHUT_WR)
+
+        while header := response.read(FRAME_HEADER.size):
+            kind, length = FRAME_HEADER.unpack(header)
+            payload = response.read(length)
+            if kind == EXIT_FRAME:
+                return int(payload)
+            stream = sys.stdout if kind == STDOUT_FRAME else sys.stderr
+            try:
+                stream.write(payload.decode())
+                stream.flush()
+            except BrokenPipeError:
+                # Output was closed early (i.e. piped to head), silence the flush at exit
+                os.dup2(os.open(os.devnull, os.O_WRONLY), stream.fileno())
+                return 1
+
+    print("Lost connection to the log query daemon", file=sys.stderr)
+    return 1
+
+
+def main():
+    """ CLI entrypoint, answering queries from a running query daemon when possible. Kept free of
+    the CLI's own imports so that forwarded queries start as quickly as possible
+    """
+    if len(sys.argv) > 1 and sys.argv[1] in DAEMON_COMMANDS:
+        code = run_remote(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+
+    from .cli import app
+    app()
@@ -14,13 +14,20 @@ MSG_FIELD = "msg"
 # Want to read a lot of the file into memory at once since decompression is expensive time-wise
 CHUNK_SIZE = 4 * 1024 * 1024
 EXCLUDE_KEYS = "level,sequence_info"
+# strptime formats of the directory levels logs are archived under, i.e. .../yyyy/mm/dd/log-name
+DATE_LAYOUT = "%Y/%m/%d"
+# Number of files to probe (open, check compression, read a boundary record) at once during discovery
+PROBE_CONCURRENCY = 16
+# Minimum partial-match score (out of 100) a value must exceed to match a fuzzy filter
+FUZZY_THRESHOLD = 75
 
 # Whether to output "fancy" with colors for interactive output
 TTY_OUTPUT = sys.stdout.isatty()
 
 # TODO code paths for timezone substititution are too nested to easily pass as arg, make global derived from
 # env instead
-DISPLAY_TZ = pytz.timezone(environ.get('LOG_TIMEZONE', 'America/Chicago'))
+DEFAULT_TZ = 'America/Chicago'
+DISPLAY_TZ = pytz.timezone(environ.get('LOG_TIMEZONE', DEFAULT_TZ))
 
 # DateTime Min/Max with a buffer for timezone conversions
 DT_BUFFERED_MIN = datetime.min + timedelta(days=365)
@@ -38,3 +45,5 @@ MsgFieldArg = Annotated[str, typer.Option(help="Structured log field containing
 ExcludeKeysArg = Annotated[str, typer.Option(help="Comma-separated structured log fields to omit from output", envvar="EXCLUDE_KEYS")]
 PartitionKeyArg = Annotated[str, typer.Option('--group-by', help="Comma-separated fields on which logs are partitioned, in addition to time", envvar="PARTITION_KEYS")]
 ChunkSizeArg = Annotated[int, typer.Option(help="Maximum chunk size of a file to read at once", envvar="CHUNK_SIZE")]
+FuzzyThresholdArg = Annotated[int, typer.Option(help="Score (0-100) a value must exceed to match a filter in fuzzy mode", envvar="FUZZY_THRESHOLD")]
+CacheArg = Annotated[bool, typer.Option("--cache/--no-cache", help="Reuse (and store) per-file results of previous identical queries", envvar="LOG_TOOLS_CACHE")]
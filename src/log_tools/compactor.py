@@ -0,0 +1,216 @@
+import io
+import os
+import re
+import sys
+import stat
+import time
+import heapq
+import typer
+import tabulate
+from typing import Annotated, Iterator
+from pathlib import Path
+from datetime import datetime
+from operator import itemgetter
+from itertools import groupby
+
+from . import common_args as ca
+from .file_utils import find_partitioned_log_files, open_possibly_compressed_file, block_index, DateRangedLogFile, COMPACTED_SUFFIX
+from .log_utils import parse_line_time
+from .log_tools import LogFilteringConfig, FilterMode
+from .seekable_gzip import SeekableGzipWriter, SeekableGzipReader, read_block_index, BLOCK_SIZE
+
+compactor = typer.Typer()
+
+# Number of records within which each file's records are put in time order as they're merged
+REORDER_WINDOW = 1000
+
+
+def compacted_path(files: list[DateRangedLogFile], partition: str) -> Path:
+    """ Path of the compacted file for a partition's files for a day, alongside the files themselves """
+    name = re.sub(r'[^\w.-]+', '_', str(partition)) or "all"
+    return Path(files[0].path).parent / f"{name}.{files[0].start_time:%Y-%m-%d}{COMPACTED_SUFFIX}"
+
+def file_identity(path: str | Path) -> tuple[str, int, int]:
+    """ Name, size and modification time of a file, to recognise it as a compacted file's source """
+    st = os.stat(path)
+    return Path(path).name, st.st_size, st.st_mtime_ns
+
+def read_records(file: DateRangedLogFile, time_key: str) -> Iterator[tuple[datetime, int, bytes]]:
+    """ Read the lines of a file along with the times of their records (and their line numbers,
+    to keep ties in order), sorted by time. As fluentd only roughly orders records within a
+    chunk, records are reordered within a window of REORDER_WINDOW records as they're read.
+    Lines without a parseable time keep their place after the record before them.
+    """
+    window: list[tuple[datetime, int, bytes]] = []
+    last_time = None
+
+    def next_record():
+        nonlocal last_time
+        record = heapq.heappop(window)
+        if last_time is not None and record[0] < last_time:
+            raise ValueError(f"{file.path} has records more than {REORDER_WINDOW} records out of order")
+        last_time = record[0]
+        return record
+
+    record_time = file.start_time
+    with open_possibly_compressed_file(file.path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            parsed, line_time = parse_line_time(line.decode(), time_key)
+            if parsed:
+                record_time = line_time
+            heapq.heappush(window, (record_time, number, line if line.endswith(b'\n') else line + b'\n'))
+            if len(window) > REORDER_WINDOW:
+                yield next_record()
+    while window:
+        yield next_record()
+
+def compact_files(files: list[DateRangedLogFile], target: Path, time_key: str, block_size: int = BLOCK_SIZE) -> int:
+    """ Merge a set of files into a single time-ordered, seekable gzip file (see seekable_gzip),
+    returning its record count. The merged file is written alongside the target, and only
+    moved into place (replacing any previous compacted file) once its record count has been
+    verified against the inputs, after which the inputs are removed. Readers listing the
+    directory in between may briefly see records twice, but never miss any. The merged file's
+    index lists its sources, so that inputs left behind by an interrupted compaction can be
+    recognised (see already_compacted) rather than merged again.
+    """
+    sources: list[tuple[str, int, int]] = []
+    for file in files:
+        index = block_index(file.path)
+        sources.extend(index.sources if index is not None else [file_identity(file.path)])
+
+    # Named so that queries never pick it up (see is_temporary_file), even if compaction is killed
+    tmp_path = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    try:
+        expected = 0
+        with open(tmp_path, 'wb') as f:
+            writer = SeekableGzipWriter(f, time_key, block_size)
+            for record_time, _, line in heapq.merge(*(read_records(file, time_key) for file in files), key=itemgetter(0)):
+                writer.write(line, record_time)
+                expected += 1
+            writer.index.sources = sources
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Read the merged file back through its index before replacing anything
+        index = read_block_index(tmp_path)
+        if index is None:
+            raise ValueError("Merged file has no index")
+        with io.BufferedReader(SeekableGzipReader(tmp_path, index)) as f:
+            written = sum(1 for line in f if line.strip())
+        if written != expected or index.records != expected:
+            raise ValueError(f"Merged file has {written} of {expected} records")
+
+        # Keep the newest modification time of the inputs, which bounds the time of the last record
+        # (see times), along with their permissions
+        source = max((os.stat(file.path) for file in files), key=lambda st: st.st_mtime_ns)
+        os.chmod(tmp_path, stat.S_IMODE(source.st_mode))
+        os.utime(tmp_path, ns=(source.st_atime_ns, source.st_mtime_ns))
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    # Make sure the merged file is durable before removing the files it replaces
+    dir_fd = os.open(target.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    for file in files:
+        if Path(file.path) != target:
+            os.unlink(file.path)
+    return expected
+
+def already_compacted(files: list[DateRangedLogFile], target: Path) -> list[DateRangedLogFile]:
+    """ Files which the (existing) target was already compacted from, left behind when a
+    compaction was interrupted between replacing the target and removing its inputs
+    """
+    index = block_index(target) if target.exists() else None
+    if index is None:
+        return []
+    sources = set(index.sources)
+    return [f for f in files if Path(f.path) != target and file_identity(f.path) in sources]
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+@compactor.callback(invoke_without_command=True)
+def compact_log_files(
+        log_path: ca.LogPathOpt,
+        start_date: ca.StartDateArg = ca.DT_BUFFERED_MIN,
+        since: ca.SinceArg = None,
+        end_date: ca.EndDateArg = ca.DT_BUFFERED_MAX,
+        until: ca.UntilArg = None,
+        time_field: ca.TimeFieldArg = ca.TIME_FIELD,
+        partition_key: ca.PartitionKeyArg = "",
+        block_size: Annotated[int, typer.Option(help="Uncompressed size (in bytes) of each independently compressed block, i.e. the granularity of seeks within compacted files")] = BLOCK_SIZE,
+        min_age: Annotated[int, typer.Option(help="Minimum time (in minutes) since a file was last written to for it to be compacted, to leave files fluentd may still be writing alone")] = 60,
+        dry_run: Annotated[bool, typer.Option(help="List the files that would be compacted without compacting them")] = False,
+):
+    """ Merge each partition's log files for a day into a single time-ordered, compressed file
+    with an embedded time index, which the other commands can seek through by time or offset
+    rather than decompressing from the start. Re-running compaction merges any newer files
+    into the existing compacted file, and removes any files an interrupted run already merged.
+    """
+    if not partition_key:
+        raise typer.BadParameter("--group-by is required, so that different partitions' logs aren't merged together")
+
+    filter_config = LogFilteringConfig(
+        start_date,
+        since,
+        end_date,
+        until,
+        time_field,
+        None,
+        None,
+        None,
+        None,
+        partition_key,
+        [],
+        FilterMode.RAW)
+
+    min_mtime = time.time() - min_age * 60
+    rows: list[tuple[str, str, int, str, str, str]] = []
+    failed = False
+    for partition, files in find_partitioned_log_files(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key).items():
+        files = [f for f in files if os.stat(f.path).st_mtime <= min_mtime]
+        files.sort(key=lambda f: (Path(f.path).parent, f.start_time.date()))
+        for _, group in groupby(files, key=lambda f: (Path(f.path).parent, f.start_time.date())):
+            group = list(group)
+            target = compacted_path(group, partition)
+            if leftovers := already_compacted(group, target):
+                print(f"{'Would remove' if dry_run else 'Removing'} {len(leftovers)} files already compacted into {target}", file=sys.stderr)
+                if not dry_run:
+                    for file in leftovers:
+                        os.unlink(file.path)
+                group = [f for f in group if f not in leftovers]
+            paths = [Path(f.path) for f in group]
+            if paths == [target] and block_index(target) is not None:
+                continue
+            if target.exists() and target not in paths:
+                print(f"Not replacing {target}, which isn't among the files being compacted for {partition}", file=sys.stderr)
+                failed = True
+                continue
+
+            size = sum(os.path.getsize(p) for p in paths)
+            records, compacted_size = "", ""
+            if not dry_run:
+                try:
+                    records = compact_files(group, target, time_field, block_size)
+                    compacted_size = format_size(os.path.getsize(target))
+                except (ValueError, OSError) as e:
+                    print(f"Unable to compact {len(group)} files into {target}: {e}", file=sys.stderr)
+                    failed = True
+                    continue
+            rows.append((partition, f"{group[0].start_time:%Y-%m-%d}", len(group), records, format_size(size), compacted_size))
+
+    print(tabulate.tabulate(rows, headers=[partition_key.title(), "Day", "Files", "Records", "Size", "Compacted Size"], tablefmt='rounded_outline'))
+    if failed:
+        raise typer.Exit(1)
@@ -0,0 +1,205 @@
+import typer
+import os
+import io
+import sys
+import json
+import pickle
+import socket
+import socketserver
+import signal
+import tempfile
+import traceback
+import pytz
+from typing import Annotated
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from dotenv import load_dotenv, find_dotenv
+
+from . import common_args as ca
+from . import file_utils, log_utils
+from .client import DEFAULT_SOCKET, STDOUT_FRAME, STDERR_FRAME, EXIT_FRAME, send_frame
+
+daemon = typer.Typer()
+
+
+class FramedWriter(io.TextIOBase):
+    """ Text stream that forwards writes to a daemon client as frames of a single kind,
+    batching small writes (i.e. individual print calls) into larger frames
+    """
+    def __init__(self, sock: socket.socket, kind: bytes, tty: bool, buffer_size: int = 64 * 1024):
+        self.sock = sock
+        self.kind = kind
+        self.tty = tty
+        self.buffer_size = buffer_size
+        self._buf: list[str] = []
+        self._buffered = 0
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, s: str):
+        self._buf.append(s)
+        self._buffered += len(s)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self._buf:
+            send_frame(self.sock, self.kind, ''.join(self._buf).encode())
+            self._buf.clear()
+            self._buffered = 0
+
+
+@contextmanager
+def client_context(request: dict):
+    """ Run a query as if it were invoked from the client process, with its working
+    directory, environment (including any .env file), display timezone and terminal
+    """
+    saved_cwd, saved_env = os.getcwd(), dict(os.environ)
+    saved_tz, saved_colors = ca.DISPLAY_TZ, log_utils.COLOR_CODES
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        load_dotenv(find_dotenv(usecwd=True))
+        ca.DISPLAY_TZ = log_utils.DISPLAY_TZ = pytz.timezone(os.environ.get('LOG_TIMEZONE', ca.DEFAULT_TZ))
+        log_utils.COLOR_CODES = log_utils.ANSI_COLOR_CODES if request["tty"] else log_utils.NO_COLOR_CODES
+        yield
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        ca.DISPLAY_TZ = log_utils.DISPLAY_TZ = saved_tz
+        log_utils.COLOR_CODES = saved_colors
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """ Run a single CLI invocation sent by client.run_remote, streaming its output back
+    """
+    def handle(self):
+        from .cli import app
+
+        request = json.loads(self.rfile.read())
+        out = FramedWriter(self.connection, STDOUT_FRAME, request["tty"])
+        err = FramedWriter(self.connection, STDERR_FRAME, request["tty"])
+
+        code = 0
+        try:
+            with client_context(request), redirect_stdout(out), redirect_stderr(err):
+                try:
+                    app(args=request["argv"], prog_name="chtc-log-tools")
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else int(e.code is not None)
+                except (BrokenPipeError, ConnectionResetError):
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+            out.flush()
+            err.flush()
+            send_frame(self.connection, EXIT_FRAME, str(code).encode())
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid-query (i.e. output piped to head), nothing left to report
+            pass
+
+
+class QueryServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """ Serve each query in a forked worker, so that a client that stops reading its output (i.e.
+    paused in a pager) can't hold up any others. Threads won't do, as queries swap out the
+    process's working directory, environment and standard streams. Workers leave the file
+    probes they make in a temporary file, to be merged into the catalog later workers inherit
+    once they exit. Only the worker's exit is signalled over a pipe, so workers never wait on
+    the server to read their updates.
+    """
+    # Don't wait on workers stuck writing to paused clients when shutting down
+    block_on_close = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending_updates: dict[int, io.BufferedRandom] = {}
+        self._update_file: io.BufferedRandom = None
+
+    def process_request(self, request, client_address):
+        self._update_file = tempfile.TemporaryFile()
+        read_fd, write_fd = os.pipe()
+        # Only returns in the parent, the worker exits (closing its end of the pipe) once it
+        # has finished the request
+        super().process_request(request, client_address)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self._pending_updates[read_fd] = self._update_file
+
+    def finish_request(self, request, client_address):
+        for fd, updates in self._pending_updates.items():
+            os.close(fd)
+            updates.close()
+        file_utils.file_catalog.track_updates()
+        try:
+            super().finish_request(request, client_address)
+        finally:
+            pickle.dump(file_utils.file_catalog.updates, self._update_file)
+            self._update_file.close()
+
+    def service_actions(self):
+        """ Reap finished workers and merge in the catalog updates of those that have exited """
+        super().service_actions()
+        for fd, updates in list(self._pending_updates.items()):
+            try:
+                os.read(fd, 1)
+            except BlockingIOError:
+                continue
+            os.close(fd)
+            del self._pending_updates[fd]
+            with updates:
+                updates.seek(0)
+                try:
+                    file_utils.file_catalog.merge(pickle.load(updates))
+                except (pickle.UnpicklingError, EOFError):
+                    # The worker died before writing its updates
+                    pass
+
+
+@daemon.callback(invoke_without_command=True)
+def serve(
+        socket_path: Annotated[str, typer.Option(help="Unix socket on which to listen for queries", envvar="LOG_TOOLS_SOCKET")] = DEFAULT_SOCKET,
+):
+    """ Run a resident query daemon on a local Unix socket. While it is running, filter, stats
+    and times queries are transparently forwarded to it, reusing its already-imported modules
+    and its catalog of file probes. The catalog re-validates each file and directory against
+    its size and modification time, so changes to the log tree are picked up on the next query.
+    """
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(f"A log query daemon is already listening on {socket_path}", file=sys.stderr)
+            raise typer.Exit(1)
+        except OSError:
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    file_utils.file_catalog = file_utils.FileCatalog()
+
+    # Queries run with the daemon owner's permissions, don't let other users connect
+    umask = os.umask(0o177)
+    try:
+        server = QueryServer(socket_path, QueryHandler)
+    finally:
+        os.umask(umask)
+
+    # Clean up the socket on termination as well as on interrupt
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    print(f"Serving log queries on {socket_path}", file=sys.stderr)
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
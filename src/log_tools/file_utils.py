@@ -1,70 +1,252 @@
 import os
 import gzip
+import math
+import threading
 import magic
 from pathlib import Path
-from typing import Iterator, Any
+from typing import Iterator, Iterable, Callable, Any, TypeVar
+from concurrent.futures import ThreadPoolExecutor
 import io
 from datetime import datetime, timezone, timedelta
 from dataclasses import dataclass
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from .log_utils import safe_parse_line
-from .common_args import CHUNK_SIZE, TIME_FIELD, DT_BUFFERED_MIN, DT_BUFFERED_MAX
+from .seekable_gzip import BlockIndex, SeekableGzipReader, read_block_index
+from .common_args import CHUNK_SIZE, TIME_FIELD, DT_BUFFERED_MIN, DT_BUFFERED_MAX, DATE_LAYOUT, PROBE_CONCURRENCY
+
+class FileCatalog:
+    """ Memoize per-file probes (first/last records, directory listings, decoded tail windows)
+    for a long-running process. Entries are keyed on a path and validated against its size and
+    modification time, so files that are appended to or replaced are transparently re-probed.
+    Safe to share between probe_files threads; values are computed outside of its lock.
+    """
+    def __init__(self, max_tail_bytes: int = 256 * 1024 * 1024):
+        self._lock = threading.Lock()
+        self.max_tail_bytes = max_tail_bytes
+        self._probes: dict[tuple[Path, Any], tuple[tuple[int, int], Any]] = {}
+        self._tails: OrderedDict[tuple[Path, int], tuple[tuple[int, int], Any]] = OrderedDict()
+        self._tail_bytes = 0
+        # Entries computed since track_updates was called, if it has been
+        self.updates: list[tuple[str, Any, tuple[tuple[int, int], Any]]] = None
+
+    def track_updates(self):
+        """ Record the entries computed from here on, i.e. by a forked query worker, so that
+        they can be merged back into its parent's catalog
+        """
+        self.updates = []
+
+    def merge(self, updates: list[tuple[str, Any, tuple[tuple[int, int], Any]]]):
+        with self._lock:
+            for kind, key, entry in updates:
+                if kind == "probe":
+                    self._probes[key] = entry
+                else:
+                    self._store_tail(key, entry)
+
+    @staticmethod
+    def _identity(path: Path) -> tuple[int, int]:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _tail_size(tail: tuple[list[str], int, bytes]) -> int:
+        lines, _, buffer = tail
+        return sum(len(line) for line in lines) + len(buffer or b'')
+
+    def probe(self, path: Path, kind: Any, compute):
+        """ Return the cached result of a probe of the given kind, or compute it if the path is
+        new or has changed since it was last probed
+        """
+        identity = self._identity(path)
+        with self._lock:
+            cached = self._probes.get((path, kind))
+        if cached and cached[0] == identity:
+            return cached[1]
+        value = compute()
+        with self._lock:
+            self._probes[(path, kind)] = (identity, value)
+            if self.updates is not None:
+                self.updates.append(("probe", (path, kind), (identity, value)))
+        return value
+
+    def tail(self, path: Path, chunk_size: int, compute):
+        """ Like probe, but for the (large) tail window of a file, keeping just the most
+        recently used windows, up to max_tail_bytes of them, in memory
+        """
+        identity = self._identity(path)
+        key = (path, chunk_size)
+        with self._lock:
+            cached = self._tails.get(key)
+            if cached and cached[0] == identity:
+                self._tails.move_to_end(key)
+                return cached[1]
+        value = compute()
+        with self._lock:
+            self._store_tail(key, (identity, value))
+            if self.updates is not None:
+                self.updates.append(("tail", key, (identity, value)))
+        return value
+
+    def _store_tail(self, key: tuple[Path, int], entry: tuple[tuple[int, int], Any]):
+        if (replaced := self._tails.pop(key, None)) is not None:
+            self._tail_bytes -= self._tail_size(replaced[1])
+        self._tails[key] = entry
+        self._tail_bytes += self._tail_size(entry[1])
+        while self._tail_bytes > self.max_tail_bytes and self._tails:
+            _, evicted = self._tails.popitem(last=False)
+            self._tail_bytes -= self._tail_size(evicted[1])
+
+# Set by long-running processes (i.e. the query daemon) to keep file probes warm between queries
+file_catalog: FileCatalog = None
+
+# libmagic handles serialize their use behind a lock, so give each probing thread its own
+_mime = threading.local()
+
+def is_compressed_file(file_path: Path) -> bool:
+    """ Using python-magic, check whether a file is gzip-compressed """
+    if not hasattr(_mime, "magic"):
+        _mime.magic = magic.Magic(mime=True)
+    return 'gzip' in _mime.magic.from_file(file_path)
+
+# Compacted files are named as such (see compactor), which saves reading the footer of every other file
+COMPACTED_SUFFIX = ".compact.log.gz"
+
+def block_index(file_path: Path) -> BlockIndex | None:
+    """ The block index of a compacted (seekable gzip) file, or None for any other file """
+    if not str(file_path).endswith(COMPACTED_SUFFIX):
+        return None
+    if file_catalog is not None:
+        return file_catalog.probe(file_path, "index", lambda: read_block_index(file_path))
+    return read_block_index(file_path)
 
 def open_possibly_compressed_file(file_path: Path) -> io.BytesIO:
     """ Using python-magic, expose a plaintext or compressed file in 
     read-binary mode via a unified interface
     """
-    mime = magic.Magic(mime=True)
-    file_type = mime.from_file(file_path)
-    is_compressed = 'gzip' in file_type
-    
-    open_func = gzip.open if is_compressed else open
+    # Compacted files can be seeked without decompressing everything before the new position
+    if (index := block_index(file_path)) is not None:
+        return io.BufferedReader(SeekableGzipReader(file_path, index))
+
+    open_func = gzip.open if is_compressed_file(file_path) else open
     
     return open_func(file_path, 'rb')
 
+def uncompressed_size(file_path: Path) -> int | None:
+    """ Size of a file's contents, or None for compressed files other than compacted ones. The
+    gzip trailer only records the size of the last member (i.e. of one append, for fluentd's
+    append mode), modulo 4GiB, so it can't be relied on without decompressing the file.
+    """
+    if (index := block_index(file_path)) is not None:
+        return index.size
+    if not is_compressed_file(file_path):
+        return os.path.getsize(file_path)
+    return None
 
-def read_file_reverse(file_path: Path, chunk_size=CHUNK_SIZE) -> Iterator[str]:
-    """ Reads a regular or compressed (.gz) text file line by line in reverse 
-    order using chunk-based processing.
+def file_chunk_count(file_path: Path, chunk_size: int = CHUNK_SIZE) -> int | None:
+    """ Number of chunks of a file that read_file_chunks can seek to, or None if its size can't
+    be found without reading all of it (see uncompressed_size)
     """
+    if (size := uncompressed_size(file_path)) is None:
+        return None
+    return max(1, math.ceil(size / chunk_size))
+
+def read_file_lines(file_path: Path) -> list[str]:
     with open_possibly_compressed_file(file_path) as f:
-        f.seek(0, os.SEEK_END)
-        file_size = f.tell()
+        return [line.rstrip(b'\n').decode() for line in f if line.strip()]
 
-        buffer = None
-        position = file_size
+def read_file_chunks(file_path: Path, chunk_indexes: list[int], chunk_size: int = CHUNK_SIZE) -> Iterator[list[str]]:
+    """ For each of a set of (ascending) chunk indexes, read the lines of a file that start
+    within that chunk. Every line starts in exactly one chunk, so chunks can be sampled without
+    double-counting lines that straddle chunk boundaries. Plain and compacted files are seeked
+    directly to each chunk; other compressed files have to be decompressed up to it.
+    """
+    with open_possibly_compressed_file(file_path) as f:
+        # Offset of a known line start at the file's current position
+        position = 0
+        for index in chunk_indexes:
+            start, end = index * chunk_size, (index + 1) * chunk_size
+            if position < start:
+                # Skip over the rest of any line starting in an earlier chunk
+                f.seek(start - 1)
+                if f.read(1) != b'\n':
+                    f.readline()
+                position = f.tell()
 
-        while position > 0:
-            read_size = min(chunk_size, position)
-            position -= read_size
+            data = f.read(end - position) if position < end else b''
+            if data and not data.endswith(b'\n'):
+                data += f.readline()
+            position += len(data)
 
-            f.seek(position)
-            chunk = f.read(read_size)
+            yield [line.decode() for line in data.split(b'\n') if line.strip()]
 
-            lines = chunk.split(b'\n')
 
-            if buffer is not None:
-                if chunk[-1] == b'\n':
-                    yield buffer  # Yield previous buffer since it's complete
-                else:
-                    lines[-1] += buffer  # Merge buffer with last line of current chunk
+def _read_chunk_reverse(f: io.BytesIO, position: int, buffer: bytes, chunk_size: int) -> tuple[list[str], int, bytes]:
+    """ Read the chunk of an open file ending at position, returning its complete lines in
+    reverse order, along with the position and partial first line to carry into the next
+    (earlier) chunk
+    """
+    read_size = min(chunk_size, position)
+    position -= read_size
+
+    f.seek(position)
+    chunk = f.read(read_size)
+
+    lines = chunk.split(b'\n')
 
-            buffer = lines.pop(0) if position != 0 else None  # Save first line for next chunk
+    if buffer is not None:
+        lines[-1] += buffer  # Merge buffer with last line of current chunk
 
-            # Yield non-empty lines in reverse order
-            for line in reversed(lines):
-                if line.strip():
-                    yield line.decode()
+    buffer = lines.pop(0) if position != 0 else None  # Save first line for next chunk
 
-        # Yield the last buffered line if it's valid
-        if buffer and buffer.strip():
-            yield buffer
+    # Keep non-empty lines in reverse order
+    return [line.decode() for line in reversed(lines) if line.strip()], position, buffer
+
+def _read_file_tail(file_path: Path, chunk_size: int) -> tuple[list[str], int, bytes]:
+    """ Read just the last chunk of a file, as per _read_chunk_reverse """
+    with open_possibly_compressed_file(file_path) as f:
+        f.seek(0, os.SEEK_END)
+        return _read_chunk_reverse(f, f.tell(), None, chunk_size)
+
+def read_file_reverse(file_path: Path, chunk_size=CHUNK_SIZE, end_time: datetime = None, time_key: str = TIME_FIELD, cache_tail: bool = False) -> Iterator[str]:
+    """ Reads a regular or compressed (.gz) text file line by line in reverse 
+    order using chunk-based processing. Given an end time, reading compacted files skips
+    over the blocks whose records (by time_key) all come after it. With cache_tail, the last
+    chunk is kept in the file catalog (if any), which is meant for the active (last) file of
+    each partition that most queries start from.
+    """
+    position, buffer = None, None
+    if end_time is not None and (index := block_index(file_path)) is not None and index.time_key == time_key:
+        position = index.position_after(end_time)
+        if position == index.size:
+            position = None
+
+    # Serve the last chunk from the catalog when one is available, only opening the file
+    # if the caller iterates past it
+    if file_catalog is not None and cache_tail and position is None:
+        lines, position, buffer = file_catalog.tail(file_path, chunk_size, lambda: _read_file_tail(file_path, chunk_size))
+        yield from lines
+        if position == 0:
+            return
+
+    with open_possibly_compressed_file(file_path) as f:
+        if position is None:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+
+        while position > 0:
+            lines, position, buffer = _read_chunk_reverse(f, position, buffer, chunk_size)
+            yield from lines
 
 def _is_structured_logs(file_path: Path, time_key: str) -> tuple[bool, dict[str, Any]]:
     """ 
     Check whether a given file (probably) contains structured logs by checking whether
     its first line is JSON-deserializable
     """
+    if file_catalog is not None:
+        return file_catalog.probe(file_path, ("first", time_key), lambda: _read_first_record(file_path, time_key))
+    return _read_first_record(file_path, time_key)
+
+def _read_first_record(file_path: Path, time_key: str) -> tuple[bool, dict[str, Any]]:
     with open_possibly_compressed_file(file_path) as f:
         # TODO handle/skip headers?
         line = f.readline().decode()
@@ -85,76 +267,194 @@ class DateRangedLogFile:
         return earliest_end > latest_start
 
 
-def find_log_files(log_paths: list[Path], max_depth = 999) -> Iterator[Path]:
+T = TypeVar("T")
+
+def probe_concurrency() -> int:
+    """ The number of files to probe at once, read from the environment like date_layout """
+    return int(os.environ.get('LOG_PROBE_CONCURRENCY', PROBE_CONCURRENCY))
+
+def probe_files(probe: Callable[[Path], T], paths: Iterable[Path]) -> Iterator[T]:
+    """ Run a per-file probe (i.e. reading a file's first or last record) over a set of paths
+    on a thread pool, overlapping the latency of opening and reading each file. Results are
+    yielded in the same order as the paths.
+    """
+    workers = probe_concurrency()
+    if workers <= 1:
+        yield from map(probe, paths)
+        return
+    with ThreadPoolExecutor(workers, thread_name_prefix="probe") as pool:
+        yield from pool.map(probe, paths)
+
+def date_layout() -> list[str]:
+    """ The strptime formats of the directory levels that logs are archived under, i.e.
+    .../yyyy/mm/dd/log-name by default. Read from the environment on each call so that
+    the query daemon follows its clients' configuration.
+    """
+    return os.environ.get('LOG_DATE_LAYOUT', DATE_LAYOUT).split('/')
+
+def _date_dir_range(values: list[str], layout: list[str]) -> tuple[datetime, datetime]:
+    """ Parse the time span covered by a directory at the given date layout level, i.e. a whole
+    month for .../yyyy/mm. Raises ValueError if the directory names don't fit the layout
+    """
+    formats = '/'.join(layout[:len(values)])
+    # TODO we have to assume here logs' default timestamps are in utc
+    start = datetime.strptime('/'.join(values), formats).replace(tzinfo=timezone.utc)
+    if '%H' in formats:
+        end = start + timedelta(hours=1)
+    elif '%d' in formats or '%j' in formats:
+        end = start + timedelta(days=1)
+    elif '%m' in formats or '%b' in formats:
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    else:
+        end = start.replace(year=start.year + 1)
+    return start, end
+
+def _date_dir_in_range(values: list[str], layout: list[str], start_date: datetime, end_date: datetime) -> bool:
+    """ Check whether a date layout directory may hold logs in a date range. Only directories that
+    fit the whole layout (i.e. a day) are conclusive, as numeric names such as job IDs or ports
+    can pass for years and months too. Raises ValueError if the directory names don't fit the layout
+    """
+    dir_start, dir_end = _date_dir_range(values, layout)
+    if len(values) < len(layout):
+        return True
+    return DateRangedLogFile(None, None, dir_start, dir_end).contains_logs_for(start_date, end_date)
+
+def _match_date_layout(path: Path, layout: list[str]) -> list[str]:
+    """ Return the longest run of trailing path components that fits the start of the date layout """
+    for depth in range(len(layout), 0, -1):
+        values = list(path.parts[-depth:])
+        if len(values) < depth:
+            continue
+        try:
+            _date_dir_range(values, layout)
+            return values
+        except ValueError:
+            continue
+    return []
+
+def is_temporary_file(file_path: Path) -> bool:
+    """ Check whether a file is a hidden temporary file (i.e. a compacted file being written, or
+    left behind by a compaction that was killed), which never holds complete logs
+    """
+    return file_path.name.startswith('.') and file_path.name.endswith('.tmp')
+
+def find_log_files(
+        log_paths: list[Path],
+        start_date: datetime = None,
+        end_date: datetime = None,
+        max_depth = 999) -> Iterator[Path]:
     """ Given a set of log paths or directories containing logs, and a max search depth, 
-    yield all individual files in those paths
+    yield all individual files in those paths, other than temporary files. If given a date range,
+    skip over any directories that fit the whole date layout (see date_layout) and fall entirely
+    outside of it without descending into them.
     """
+    prune = start_date is not None and end_date is not None
+    layout = date_layout()
     for p in log_paths:
         if p.is_file():
-            yield p
+            if not prune or file_path_in_date_range(p, start_date, end_date):
+                yield p
             continue
-        dirs: list[tuple[Path, int]] = [(p, 0)]
+        root_date = _match_date_layout(p, layout)
+        if prune and root_date and not _date_dir_in_range(root_date, layout, start_date, end_date):
+            continue
+        # Directories to visit, along with the date layout components matched on the way to them
+        dirs: list[tuple[Path, int, list[str]]] = [(p, 0, root_date)]
         while len(dirs) and (dir_tuple := dirs.pop()):
-            cur_dir, cur_depth = dir_tuple
-            for f in cur_dir.iterdir():
-                if f.is_file():
-                    yield f
-                elif f.is_dir() and cur_depth < max_depth:
-                    dirs.append([f, cur_depth + 1])
+            cur_dir, cur_depth, cur_date = dir_tuple
+            entries = _list_dir(cur_dir) if file_catalog is None else file_catalog.probe(cur_dir, "listdir", lambda: _list_dir(cur_dir))
+            for f, is_file, is_dir in entries:
+                if is_file:
+                    if not is_temporary_file(f):
+                        yield f
+                elif is_dir and cur_depth < max_depth:
+                    date = []
+                    if len(cur_date) < len(layout):
+                        try:
+                            date = [*cur_date, f.name]
+                            if prune and not _date_dir_in_range(date, layout, start_date, end_date):
+                                continue
+                        except ValueError:
+                            # Not a date layout directory
+                            date = []
+                    dirs.append((f, cur_depth + 1, date))
+
+def _list_dir(dir_path: Path) -> list[tuple[Path, bool, bool]]:
+    with os.scandir(dir_path) as entries:
+        return [(Path(e.path), e.is_file(), e.is_dir()) for e in entries]
             
 
 def file_path_in_date_range(file_path: Path, start_date: datetime, end_date: datetime):
-    """ Check if a log file's full path is in the format .../yyyy/mm/dd/log-name. If so,
+    """ Check if a log file's full path is in the date layout, i.e. .../yyyy/mm/dd/log-name. If so,
     pre-filter based on the supplied date ranges.
     """
-
+    layout = date_layout()
     try:
-        # Try to parse the last 3 directories of the file path as a yyyy-mm-dd string
-        date_str = '-'.join(file_path.parts[-4:-1])
-        # TODO we have to assume here logs' default timestamps are in utc
-        file_start = datetime.fromisoformat(date_str).replace(tzinfo=timezone.utc)
-        file_end = file_start + timedelta(days=1)
-        return DateRangedLogFile(file_path, None, file_start, file_end).contains_logs_for(start_date, end_date)
+        # Try to parse the parent directories of the file path as a full date
+        return _date_dir_in_range(list(file_path.parts[-len(layout) - 1:-1]), layout, start_date, end_date)
     except ValueError as e:
         # Can't determine a date based on file path, need to read records
         return True
 
-def find_log_files_in_date_range(
-        log_paths: list[Path], 
+def find_partitioned_log_files(
+        log_paths: list[Path],
         start_date: datetime = DT_BUFFERED_MIN,
         end_date: datetime = DT_BUFFERED_MAX,
-        time_key: str = TIME_FIELD, 
-        partition_key: str = "",
-        chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[str, list[DateRangedLogFile]]]:
+        time_key: str = TIME_FIELD,
+        partition_key: str = "") -> dict[str, list[DateRangedLogFile]]:
+    """ Find the structured log files under a set of paths, grouped by partition key and sorted
+    by the time of their first record. Only each file's first record is read, so the end of
+    each file is taken to be the start of the next, and left unbounded for the last file
+    in each partition.
+    """
     sorted_files : dict[str, list[DateRangedLogFile]] = defaultdict(lambda: [])
-    # Find all newline-delimited JSON files in the given directory(s)
-    for file_path in find_log_files(log_paths):
-        # Hacky, but attempt to pre-filter files that are not in the supplied date range
-        # by parsing its date range out of its file path
-        if not file_path_in_date_range(file_path, start_date, end_date):
-            continue
-        parsed, fields = _is_structured_logs(file_path, time_key)
+    # Find all newline-delimited JSON files in the given directory(s), skipping over directories
+    # whose date (as parsed from their path) is outside of the supplied date range
+    file_paths = list(find_log_files(log_paths, start_date, end_date))
+    for file_path, (parsed, fields) in zip(file_paths, probe_files(lambda p: _is_structured_logs(p, time_key), file_paths)):
         # Filter out ndjson objects that don't contain the expected time key
         if not parsed or not time_key in fields:
             continue
         sorted_files[fields.get(partition_key, "")].append(DateRangedLogFile(file_path, fields, fields[time_key]))
 
-
-    for key, files in sorted_files.items():
+    for files in sorted_files.values():
         files.sort(key = lambda file: file.start_time)
 
         # set the end of each file to the start of the next
         for file, next_file in zip(files, files[1:]):
             file.end_time = next_file.start_time
 
+    return sorted_files
+
+def read_last_record(file_path: Path, time_key: str = TIME_FIELD, chunk_size: int = CHUNK_SIZE) -> dict[str, Any]:
+    """ Return the last parseable record of a log file, or None if it has none """
+    if file_catalog is not None:
+        return file_catalog.probe(file_path, ("last", time_key), lambda: _read_last_record(file_path, time_key, chunk_size))
+    return _read_last_record(file_path, time_key, chunk_size)
 
+def _read_last_record(file_path: Path, time_key: str, chunk_size: int) -> dict[str, Any]:
+    for l in read_file_reverse(file_path, chunk_size):
+        parsed, fields = safe_parse_line(l, time_key)
+        if parsed:
+            return fields
+    return None
+
+def file_modified_time(file_path: Path) -> datetime:
+    return datetime.fromtimestamp(int(os.stat(file_path).st_mtime), timezone.utc)
+
+def find_log_files_in_date_range(
+        log_paths: list[Path], 
+        start_date: datetime = DT_BUFFERED_MIN,
+        end_date: datetime = DT_BUFFERED_MAX,
+        time_key: str = TIME_FIELD, 
+        partition_key: str = "",
+        chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[str, list[DateRangedLogFile]]]:
+    partitions = find_partitioned_log_files(log_paths, start_date, end_date, time_key, partition_key)
+    last_records = probe_files(lambda p: read_last_record(p, time_key, chunk_size), [files[-1].path for files in partitions.values()])
+    for (key, files), last_record in zip(partitions.items(), last_records):
         # set the end of the last file by reading its last record
-        for l in read_file_reverse(files[-1].path, chunk_size):
-            parsed, fields = safe_parse_line(l, time_key)
-            if not parsed:
-                continue
-            files[-1].end_time = fields[time_key]
-            break
+        if last_record is not None:
+            files[-1].end_time = last_record[time_key]
 
         # Filter down to the list of files containing records in the date range
         in_range_files = [f for f in files if f.contains_logs_for(start_date, end_date)]
@@ -164,10 +464,11 @@ def find_log_files_in_date_range(
         yield (key, in_range_files[::-1])
 
 
-def read_files_reverse(files: list[DateRangedLogFile], chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
-    for file in files:
+def read_files_reverse(files: list[DateRangedLogFile], chunk_size: int = CHUNK_SIZE, end_time: datetime = None, time_key: str = TIME_FIELD) -> Iterator[str]:
+    # Files are newest first, so only the first can be a partition's active file
+    for i, file in enumerate(files):
         fname = file.path
-        for line in read_file_reverse(fname, chunk_size):
+        for line in read_file_reverse(fname, chunk_size, end_time, time_key, cache_tail=i == 0):
             yield line
 
 def aggregate_log_files(
@@ -0,0 +1,31 @@
+from functools import lru_cache
+from rapidfuzz import fuzz
+
+from .common_args import FUZZY_THRESHOLD
+
+# Log messages repeat heavily, so a modest cache of already-scored values absorbs most lookups
+FUZZY_CACHE_SIZE = 64 * 1024
+
+class FuzzyMatcher:
+    """ Fuzzy-match many values against a single filter string. The filter is normalized once,
+    identical values are only scored once, and the threshold is passed to rapidfuzz as a score
+    cutoff so that alignments which can't reach it are abandoned early
+    """
+    filter: str
+    threshold: int
+
+    def __init__(self, filter: str, threshold: int = FUZZY_THRESHOLD, cache_size: int = FUZZY_CACHE_SIZE):
+        self.filter = filter.lower()
+        self.threshold = threshold
+        self.matches = lru_cache(maxsize=cache_size)(self._matches)
+
+    def _matches(self, value: str) -> bool:
+        score = fuzz.partial_ratio(value.lower(), self.filter, score_cutoff=self.threshold)
+        return round(score) > self.threshold
+
+
+@lru_cache(maxsize=None)
+def fuzzy_matcher(filter: str, threshold: int = FUZZY_THRESHOLD) -> FuzzyMatcher:
+    """ Return the shared matcher for a given filter string and threshold
+    """
+    return FuzzyMatcher(filter, threshold)
@@ -1,17 +1,15 @@
 import typer
-from typing import Annotated, Any
+from typing import Annotated, Any, Iterator
 from datetime import datetime, timedelta, timezone
 from enum import Enum
 import re
-from thefuzz import fuzz
-import io
 from collections import deque
 from dataclasses import dataclass
-from contextlib import redirect_stdout, nullcontext
 
 from . import common_args as ca
-from .log_utils import safe_parse_line, dt_in_range_fix_tz, done_iterating, pretty_print, print_partition_header, convert_log_tz
-from .file_utils import find_log_files_in_date_range, read_files_reverse, DateRangedLogFile
+from .log_utils import safe_parse_line, parse_line_time, dt_in_range_fix_tz, done_iterating, pretty_print, print_partition_header, convert_log_tz
+from .file_utils import find_log_files_in_date_range, read_files_reverse, read_file_reverse, DateRangedLogFile
+from .result_cache import ResultCache
 
 filterer = typer.Typer()
 
@@ -22,7 +20,7 @@ class FilterMode(Enum):
     FUZZY = "fuzzy"
 
 
-def value_matches(value: str, filter: str, mode: FilterMode):
+def value_matches(value: str, filter: str, mode: FilterMode, fuzzy_threshold: int = ca.FUZZY_THRESHOLD):
     if not value:
         return False
     if mode == FilterMode.RAW:
@@ -30,11 +28,30 @@ def value_matches(value: str, filter: str, mode: FilterMode):
     elif mode == FilterMode.REGEX:
         return re.search(filter, value)
     else:
-        # TODO does having a fixed threshold here make sense?
-        return fuzz.partial_ratio(value.lower(), filter.lower()) > 75 
+        # Deferred so that rapidfuzz is only imported for fuzzy queries
+        from .fuzzy_match import fuzzy_matcher
+        return fuzzy_matcher(filter, fuzzy_threshold).matches(value)
+
+# Characters that JSON encoders write as-is. Others may be escaped, i.e. Go writes '>' as '\u003e'
+# and some encoders write '/' as '\/', so a filter containing them can't be found in a raw line
+_UNESCAPED_FILTER = re.compile(r'[A-Za-z0-9 _.:=-]+')
+
+def line_prefilter(filter: str, mode: FilterMode) -> str | None:
+    """ Return a string that must appear in a raw (lowercased) log line for any of its fields to
+    match a filter, if there is one. Only raw filters made up of characters that JSON never
+    escapes can rule lines out without decoding them.
+    """
+    if mode != FilterMode.RAW or not _UNESCAPED_FILTER.fullmatch(filter):
+        return None
+    return filter.lower()
+
+def line_may_match(line: str, filter: str, mode: FilterMode):
+    """ Cheaply check whether a raw (lowercased) log line could contain a field matching a filter """
+    prefilter = line_prefilter(filter, mode)
+    return prefilter is None or prefilter in line
 
 class RotatingDequeue(deque):
-    """ Store the past X log messages for printing in the before/after context window
+    """ Store the past X raw log lines for printing in the before/after context window
     """
     capacity: int
     def __init__(self, capacity: int):
@@ -53,13 +70,6 @@ class PrintedPartition:
     partition: str
     date: datetime
 
-    # Some log output modes require printing just a subset of output,
-    # buffer it per header to allow filtering before print
-    buf: io.StringIO = None
-
-    def __post_init__(self):
-        self.buf = io.StringIO()
-
     @property
     def printed_date(self) -> datetime:
         return self.date.strftime("%Y-%m-%d")
@@ -94,6 +104,8 @@ class LogFilteringConfig:
     context_window: int = 0
     _from: str = ""
     _to: str = ""
+    fuzzy_threshold: int = ca.FUZZY_THRESHOLD
+    cache: ResultCache = None
 
 
     # Stateful item to track which printed logs belong to which pod/date grouping
@@ -106,6 +118,9 @@ class LogFilteringConfig:
     _start_time: datetime = None
     _end_time: datetime = None
 
+    # Cache strings that must appear in a raw line for it to match the filters
+    _line_prefilters: list[str] = None
+
 
 
 
@@ -169,8 +184,18 @@ class LogFilteringConfig:
                 self._end_time = ca.DISPLAY_TZ.localize(self.end_date).astimezone(timezone.utc)
         return self._end_time
 
+    @property
+    def seek_end_time(self) -> datetime:
+        """ The time past which compacted files can be skipped over when reading them in reverse,
+        unless records after the end of the time range may be printed as context
+        """
+        return None if self.context_window else self.end_time
+
+    def partition_header(self, fields: dict[str, Any]) -> PrintedPartition:
+        return PrintedPartition(fields.get(self.partition_key), fields[self.time_field])
+
     def pretty_print(self, fields: dict[str, Any]):
-        line_header = PrintedPartition(fields.get(self.partition_key), fields[self.time_field])
+        line_header = self.partition_header(fields)
         if self.last_header is None or self.last_header != line_header:
             self.last_header = line_header
             print_partition_header(fields, self.time_field, self.partition_keys)
@@ -185,12 +210,37 @@ class LogFilteringConfig:
         return dt_in_range_fix_tz(self.start_time, time, self.end_time)
 
     def fields_match_filters(self, fields: dict[str, Any]):
-        return [] if not self.filter_list else (value_matches(fields.get(k), f, self.filter_mode) for k, f in self.filter_list)
+        return [] if not self.filter_list else (value_matches(fields.get(k), f, self.filter_mode, self.fuzzy_threshold) for k, f in self.filter_list)
 
+    def partition_matches_filters(self, files: list[DateRangedLogFile]):
+        """ Check the partition key of a set of files (assumed to be the same for each record in a given file)
+        against any filters on that key
+        """
+        fields = files[0].first_record
+        partition_filters = [v for k, v in self.filter_list if k == self.partition_key]
+        return all(value_matches(fields.get(self.partition_key), v, self.filter_mode, self.fuzzy_threshold) for v in partition_filters)
 
-    def write(self, *args, **kwargs):
-        if self.last_header:
-            self.last_header.buf.write(*args, **kwargs)
+    @property
+    def line_prefilters(self) -> list[str]:
+        if self._line_prefilters is None:
+            self._line_prefilters = [p for _, f in self.filter_list if (p := line_prefilter(f, self.filter_mode)) is not None]
+        return self._line_prefilters
+
+    def query_signature(self, kind: str, filters: list[tuple[str, str]] = None) -> dict[str, Any]:
+        """ Normalized description of everything (other than the time window) that determines a
+        query's per-file results, for use as a result cache key
+        """
+        return {
+            "kind": kind,
+            "filters": sorted(map(list, self.filter_list if filters is None else filters)),
+            "filter_mode": self.filter_mode.value,
+            "fuzzy_threshold": self.fuzzy_threshold if self.filter_mode == FilterMode.FUZZY else None,
+            "time_field": self.time_field,
+        }
+
+    def line_may_match_filters(self, line: str):
+        """ Check whether a raw (lowercased) line could match every filter, without decoding it """
+        return all(p in line for p in self.line_prefilters)
 
 @dataclass
 class ContextWindow:
@@ -200,10 +250,23 @@ class ContextWindow:
     _from: str
     _to: str
     filter_mode: FilterMode
+    fuzzy_threshold: int = ca.FUZZY_THRESHOLD
        
     # state variable
     in_context = None
 
+    def may_change_context(self, line: str) -> bool:
+        """ Check whether a raw (lowercased) line could move the log stream into or out of context,
+        without decoding it
+        """
+        if self.in_context is None:
+            return True
+        if self._from and not self.in_context:
+            return line_may_match(line, self._from.split('=', 1)[1], self.filter_mode)
+        if self._to and self.in_context:
+            return line_may_match(line, self._to.split('=', 1)[1], self.filter_mode)
+        return False
+
 
     def update_context(self, fields: dict[str, Any]) -> tuple[bool, bool]:
         if self.in_context is None:
@@ -212,24 +275,43 @@ class ContextWindow:
 
         if self._from and not self.in_context:
             field, _filter = self._from.split('=', 1)
-            self.in_context = value_matches(fields.get(field), _filter, self.filter_mode)
+            self.in_context = value_matches(fields.get(field), _filter, self.filter_mode, self.fuzzy_threshold)
         elif self._to and self.in_context:
             field, _filter = self._to.split('=', 1)
-            self.in_context = not value_matches(fields.get(field), _filter, self.filter_mode)
+            self.in_context = not value_matches(fields.get(field), _filter, self.filter_mode, self.fuzzy_threshold)
             if not self.in_context:
                 return (False, True)
         
         return self.in_context, False
 
-def print_partitioned_log_files(files: list[DateRangedLogFile], cfg: LogFilteringConfig):
-    # Queue to hold lines ahead of/behind matches for printing
+def iter_partitioned_log_lines(files: list[DateRangedLogFile], cfg: LogFilteringConfig) -> Iterator[dict[str, Any] | None]:
+    """ Yield the records of a partition that should be printed, in print order. A None
+    marks a gap between two non-adjacent context windows
+    """
+    # Queue to hold raw lines ahead of/behind matches, only decoded if they end up being printed
     leading_lines : deque[str] = RotatingDequeue(cfg.context_window)
     trailing_line_count = 0
     matched_lines = 0
 
-    context_window = ContextWindow(cfg._from, cfg._to, cfg.filter_mode)
+    context_window = ContextWindow(cfg._from, cfg._to, cfg.filter_mode, cfg.fuzzy_threshold)
+
+    if cfg.cache is not None and not (cfg.context_window or cfg._from or cfg._to):
+        yield from iter_cached_partition_matches(files, cfg)
+        return
+
+    for line in read_files_reverse(files, cfg.chunk_size, cfg.seek_end_time, cfg.time_field):
+        # Lines that can't be printed as a match or trailing context only need their timestamp
+        lowered = line.lower()
+        if trailing_line_count == 0 and not cfg.line_may_match_filters(lowered) and not context_window.may_change_context(lowered):
+            parsed, time = parse_line_time(line, cfg.time_field)
+            if not parsed:
+                continue
+            if not cfg.dt_in_range(time) or context_window.in_context:
+                leading_lines.append(line)
+            if cfg.done_iterating(matched_lines, time):
+                break
+            continue
 
-    for line in read_files_reverse(files, cfg.chunk_size):
         parsed, fields = safe_parse_line(line, cfg.time_field)
         if not parsed:
             continue
@@ -238,28 +320,121 @@ def print_partitioned_log_files(files: list[DateRangedLogFile], cfg: LogFilterin
         if cfg.dt_in_range(time):
             in_context, done = context_window.update_context(fields)
             if done:
-                cfg.pretty_print(fields)
+                yield fields
                 break
             elif not in_context:
                 continue
 
         if trailing_line_count > 0:
-            cfg.pretty_print(fields)
+            yield fields
             trailing_line_count -= 1
         elif cfg.dt_in_range(time) and all(cfg.fields_match_filters(fields)):
             if len(leading_lines):
-                print('   ...')
-            for field in [*leading_lines, fields]:
-                cfg.pretty_print(field)
+                yield None
+            for leading_line in leading_lines:
+                yield safe_parse_line(leading_line, cfg.time_field)[1]
+            yield fields
             leading_lines.clear()
             trailing_line_count = cfg.context_window
             matched_lines += 1
         else:
-            leading_lines.append(fields)
+            leading_lines.append(line)
 
         if trailing_line_count == 0 and cfg.done_iterating(matched_lines, time):
             break
 
+def iter_cached_partition_matches(files: list[DateRangedLogFile], cfg: LogFilteringConfig) -> Iterator[dict[str, Any]]:
+    """ Yield the records of a partition matching the filters, without any context, reusing the
+    matching lines of each file found by previous identical queries. A file's matches are only
+    cached once it has been scanned through.
+    """
+    matched_lines = 0
+    query = cfg.query_signature("filter")
+
+    for file in files:
+        key = cfg.cache.key(query, file, cfg.start_time, cfg.end_time)
+        cached = cfg.cache.get(key)
+        if cached is not None:
+            lines, done = cached
+            for line in lines:
+                yield safe_parse_line(line, cfg.time_field)[1]
+                matched_lines += 1
+                if cfg.max_lines and matched_lines >= cfg.max_lines:
+                    return
+        else:
+            lines, done = [], False
+            for line in read_file_reverse(file.path, cfg.chunk_size, cfg.seek_end_time, cfg.time_field, cache_tail=file is files[0]):
+                if not cfg.line_may_match_filters(line.lower()):
+                    parsed, time = parse_line_time(line, cfg.time_field)
+                    if not parsed:
+                        continue
+                else:
+                    parsed, fields = safe_parse_line(line, cfg.time_field)
+                    if not parsed:
+                        continue
+                    time = fields[cfg.time_field]
+                    if cfg.dt_in_range(time) and all(cfg.fields_match_filters(fields)):
+                        lines.append(line)
+                        yield fields
+                        matched_lines += 1
+                        if cfg.max_lines and matched_lines >= cfg.max_lines:
+                            return
+
+                # Unlike max_lines, stopping at the start of the time range doesn't depend on other files
+                if cfg.done_iterating(0, time):
+                    done = True
+                    break
+            cfg.cache.put(key, [lines, done])
+
+        if done:
+            return
+
+def print_partitioned_log_files(files: list[DateRangedLogFile], cfg: LogFilteringConfig):
+    for fields in iter_partitioned_log_lines(files, cfg):
+        if fields is None:
+            print('   ...')
+        else:
+            cfg.pretty_print(fields)
+
+def print_latest_partition(partitions: list[list[DateRangedLogFile]], cfg: LogFilteringConfig):
+    """ Print just the most recent [pod name, year-month-day] group of matching lines across
+    all partitions. Partitions are visited newest-first by the end time of their latest file, so
+    scanning can stop as soon as a partition's logs end before the best match found so far.
+    """
+    best_time: datetime = None
+    best_first: dict[str, Any] = None
+    best_lines: Iterator[dict[str, Any] | None] = None
+
+    for files in sorted(partitions, key=lambda files: files[0].end_time, reverse=True):
+        if best_time is not None and files[0].end_time <= best_time:
+            break
+
+        lines = iter_partitioned_log_lines(files, cfg)
+        # The first record printed for a partition is its newest, skip any leading gap marker
+        first = next((fields for fields in lines if fields is not None), None)
+        if first is None or (best_time is not None and first[cfg.time_field] <= best_time):
+            lines.close()
+            continue
+
+        if best_lines is not None:
+            best_lines.close()
+        best_time, best_first, best_lines = first[cfg.time_field], first, lines
+
+    if best_lines is None:
+        return
+
+    # Render the winning partition until its first header group ends
+    header = cfg.partition_header(best_first)
+    cfg.pretty_print(best_first)
+    for fields in best_lines:
+        if fields is None:
+            print('   ...')
+        elif cfg.partition_header(fields) != header:
+            break
+        else:
+            cfg.pretty_print(fields)
+    best_lines.close()
+
 @filterer.callback(invoke_without_command=True)
 def filter_logs_by_date(
         log_path: ca.LogPathOpt,
@@ -275,10 +450,12 @@ def filter_logs_by_date(
         partition_key: ca.PartitionKeyArg = "",
         filters: Annotated[list[str], typer.Option("-f", "--filters", help="Key-Value pairs that should appear in the logs")] = [],
         filter_mode: Annotated[FilterMode, typer.Option("-m", "--filter-mode", help="String comparison mode to use for filtering logs")] = FilterMode.RAW.value,
+        fuzzy_threshold: ca.FuzzyThresholdArg = ca.FUZZY_THRESHOLD,
         context_window: Annotated[int, typer.Option("-C", "--context", help="Number of context lines surrounding filter matches to show")] = 0,
         _from: Annotated[str, typer.Option("--from", help="Log pattern from which to start displaying lines")] = '',
         _to: Annotated[str, typer.Option("--to", help="Log pattern from which to stop displaying lines")] = '',
         latest: Annotated[bool, typer.Option("--latest", help="Print just the most recent contiguous set of log lines that match the filters")] = False,
+        cache: ca.CacheArg = False,
 ):
     """ Parse a set of newline-delimited, JSON formatted log files, printing 
     log messages that match both the specified set of text filters and
@@ -300,27 +477,22 @@ def filter_logs_by_date(
         filter_mode, 
         context_window,
         _from,
-        _to)
-
-
-    redirect_context = redirect_stdout(filter_config) if latest else nullcontext()
-    with redirect_context:
-        # Glob plain and compressed files from the input directory
-        for _, files in find_log_files_in_date_range(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key):
-            # Skip over files where the partition key (assumed to be the same for each record in a given file) doesn't
-            # match a filter
-            fields = files[0].first_record
-            partition_filters = [v for k, v in filter_config.filter_list if k == partition_key]
-            if not all(value_matches(fields.get(partition_key), v, filter_mode) for v in partition_filters):
-                continue
+        _to,
+        fuzzy_threshold,
+        ResultCache() if cache else None)
 
-            print_partitioned_log_files(files, filter_config)
 
+    # Glob plain and compressed files from the input directory, skipping over files where
+    # the partition key doesn't match a filter
+    partitions = (files for _, files in find_log_files_in_date_range(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key)
+                  if filter_config.partition_matches_filters(files))
+
+    if latest:
+        print_latest_partition(list(partitions), filter_config)
+    else:
+        for files in partitions:
+            print_partitioned_log_files(files, filter_config)
 
-    if latest and filter_config.log_partitions:
-        latest_partition = sorted(filter_config.log_partitions, key=lambda p: p.date, reverse=True)[0]
-        print(latest_partition.buf.getvalue())
-    
     if not filter_config.log_partitions:
         print(f"No logs found for given filters in given date range.")
 
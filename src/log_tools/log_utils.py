@@ -2,6 +2,7 @@ import typing
 import re
 import pytz
 import msgspec
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 from .common_args import TIME_FIELD, MSG_FIELD, DISPLAY_TZ, TTY_OUTPUT
@@ -24,6 +25,22 @@ def safe_parse_line(line: str, time_key: str) -> tuple[bool, dict[str, typing.An
         print(f"Unable to JSON-decode formatted line '{line}'")
         return False, {}
 
+@lru_cache
+def _time_decoder(time_key: str) -> msgspec.json.Decoder:
+    return msgspec.json.Decoder(msgspec.defstruct("LogTime", [("time", str)], rename={"time": time_key}))
+
+def parse_line_time(line: str, time_key: str) -> tuple[bool, datetime]:
+    """ Parse just the timestamp out of a line, skipping over (rather than building) the
+    rest of its fields
+    """
+    try:
+        record = _time_decoder(time_key).decode(line.split('\t')[-1])
+        return True, datetime.fromisoformat(record.time).replace(tzinfo=timezone.utc)
+    except (msgspec.DecodeError, ValueError):
+        # Fall back to a full parse for consistent error handling
+        parsed, fields = safe_parse_line(line, time_key)
+        return parsed, fields[time_key] if parsed else None
+
 def dt_in_range_fix_tz(start_date: datetime, date: datetime, end_date: datetime):
     """
     Check whether a given date falls within a start and stop date, applying the
@@ -51,7 +68,7 @@ def done_iterating(idx: int, max_lines: int, time: datetime, start_time: datetim
         compare_dts_fix_tz(start_time, time) > timedelta(minutes=time_window))
 
 
-COLOR_CODES = {
+ANSI_COLOR_CODES = {
     "DEBUG": "\033[36m", # Cyan
     "INFO":  "\033[32m", # Green
     "WARN":  "\033[33m", # Yellow
@@ -60,7 +77,10 @@ COLOR_CODES = {
     "PARTITION": "\033[35m", # Magenta
     "TIME": "\033[94m", # Bright Blue
     "RESET": "\033[0m" # Unset
-} if TTY_OUTPUT else defaultdict(lambda: "")
+}
+NO_COLOR_CODES = defaultdict(lambda: "")
+
+COLOR_CODES = ANSI_COLOR_CODES if TTY_OUTPUT else NO_COLOR_CODES
 
 LEVEL_RE = re.compile(r'^(DEBUG|INFO|WARN|ERROR|FATAL)[: ]*(.*)')
 
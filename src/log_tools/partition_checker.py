@@ -1,17 +1,62 @@
 import typer
 from typing import Annotated
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 import re
-from thefuzz import fuzz
 import tabulate
 
 from . import common_args as ca
-from .file_utils import find_log_files_in_date_range, read_file_reverse, safe_parse_line
+from .file_utils import find_partitioned_log_files, read_last_record, file_modified_time, probe_files, block_index, DateRangedLogFile
 from .log_tools import LogFilteringConfig, value_matches, FilterMode
 
 partition_checker = typer.Typer()
 
+
+def set_end_times(files: list[DateRangedLogFile], time_key: str, exact: bool, chunk_size: int = ca.CHUNK_SIZE):
+    """ Set the end time of each of a partition's files, either from its last record or estimated
+    from file metadata. A file's modification time is when it was last written to, so it bounds
+    the time of its last record, other than for files that were copied or touched after being
+    rotated. Clipping it to the start of the next file keeps such files from hiding any gaps.
+    Compacted files' indexes record the time of their last record, so they're never estimated.
+    """
+    if exact:
+        last_records = probe_files(lambda p: read_last_record(p, time_key, chunk_size), [file.path for file in files])
+        for file, last_record in zip(files, last_records):
+            file.end_time = last_record[time_key] if last_record else file.start_time
+    else:
+        for file in files:
+            file.end_time = max(file.start_time, min(file.end_time, file_modified_time(file.path)))
+    for file in files:
+        index = block_index(file.path)
+        if index is not None and index.time_key == time_key and index.ends:
+            file.end_time = datetime.fromtimestamp(index.ends[-1], file.start_time.tzinfo)
+
+def covered_spans(file: DateRangedLogFile, time_key: str) -> list[tuple[datetime, datetime]]:
+    """ The spans of time a file has records for: from its start to its end time, other than
+    for compacted files, whose blocks are split at any pause in records (see seekable_gzip), so
+    that their indexes give the spans between their gaps
+    """
+    index = block_index(file.path)
+    if index is None or index.time_key != time_key or len(index.ends) != len(index.times) or not index.times:
+        return [(file.start_time, file.end_time)]
+    tz = file.start_time.tzinfo
+    spans = [(datetime.fromtimestamp(start, tz), datetime.fromtimestamp(end, tz)) for start, end in zip(index.times, index.ends)]
+    spans[0] = (file.start_time, spans[0][1])
+    spans[-1] = (spans[-1][0], file.end_time)
+    return spans
+
+def coverage_gaps(files: list[DateRangedLogFile], threshold: timedelta, time_key: str = ca.TIME_FIELD) -> list[tuple[datetime, datetime]]:
+    """ Find spans longer than the threshold between the end of one file (or block of a
+    compacted file) and the start of the next
+    """
+    spans = [span for file in files for span in covered_spans(file, time_key)]
+    return [(end, next_start) for (_, end), (next_start, _) in zip(spans, spans[1:])
+            if next_start - end > threshold]
+
+def format_gap(gap: tuple[datetime, datetime]) -> str:
+    start, end = gap
+    return f"{start:%Y-%m-%d %H:%M:%S} - {end:%Y-%m-%d %H:%M:%S} ({end - start})"
+
 @partition_checker.callback(invoke_without_command=True)
 def check_log_partitions(
         log_path: ca.LogPathOpt,
@@ -21,10 +66,16 @@ def check_log_partitions(
         until: ca.UntilArg = None,
         time_field: ca.TimeFieldArg = ca.TIME_FIELD,
         partition_key: ca.PartitionKeyArg = "",
+        chunk_size: ca.ChunkSizeArg = ca.CHUNK_SIZE,
         filters: Annotated[list[str], typer.Option("-f", "--filters", help="Key-Value pairs that should appear in the logs")] = [],
         filter_mode: Annotated[FilterMode, typer.Option("-m", "--filter-mode", help="String comparison mode to use for filtering logs")] = FilterMode.RAW.value,
+        fuzzy_threshold: ca.FuzzyThresholdArg = ca.FUZZY_THRESHOLD,
+        gap_threshold: Annotated[int, typer.Option(help="Minimum length (in minutes) of a span without logs to report as a gap")] = 30,
+        exact: Annotated[bool, typer.Option(help="Read the last record of every file rather than estimating end times (for finding gaps) from file modification times")] = False,
 ):
-    """ Find the time ranges for which a given set of log partitions have records
+    """ Find the time ranges for which a given set of log partitions have records, along with
+    any gaps in each partition's coverage. Only the first record of each file, and the last
+    record of each partition, are read unless --exact is given.
     """
 
     # Parse a list of key, value pairs out of filters (assumed to be a list of "key=value" strings)
@@ -40,19 +91,27 @@ def check_log_partitions(
         None, 
         partition_key, 
         filters, 
-        filter_mode)
+        filter_mode,
+        fuzzy_threshold=fuzzy_threshold)
 
     filter_list : dict[str, str] = dict(f.split("=") for f in filters)
 
-    rows: list[tuple[str, str, str]] = []
-    for _, files in find_log_files_in_date_range(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key):
-        fields = files[-1].first_record
-        if not all(value_matches(fields.get(k), f, filter_mode) for k, f in filter_list.items()):
+    rows: list[tuple[str, str, str, str]] = []
+    for files in find_partitioned_log_files(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key).values():
+        fields = files[0].first_record
+        if not all(value_matches(fields.get(k), f, filter_mode, fuzzy_threshold) for k, f in filter_list.items()):
+            continue
+
+        set_end_times(files, time_field, exact, chunk_size)
+        files = [f for f in files if f.contains_logs_for(filter_config.start_time, filter_config.end_time)]
+        if not files:
             continue
-        start_time = files[-1].start_time
-        end_time = files[0].end_time
+        # Modification times are good enough for finding gaps, but the last record is shown
+        if not exact:
+            set_end_times(files[-1:], time_field, True, chunk_size)
 
-        rows.append((fields[partition_key], start_time, end_time))
+        gaps = coverage_gaps(files, timedelta(minutes=gap_threshold), time_field)
+        rows.append((fields.get(partition_key, ""), files[0].start_time, files[-1].end_time, '\n'.join(format_gap(g) for g in gaps)))
 
-    print(tabulate.tabulate(rows, headers=[partition_key.title(), "First Record", "Last Record"], tablefmt='rounded_outline'))
+    print(tabulate.tabulate(rows, headers=[partition_key.title(), "First Record", "Last Record", "Gaps"], tablefmt='rounded_outline'))
 
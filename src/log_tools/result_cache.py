@@ -0,0 +1,99 @@
+import os
+import hashlib
+import msgspec
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Callable
+
+from .file_utils import DateRangedLogFile
+
+# Bump whenever the format of cached results changes
+CACHE_FORMAT = 1
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "chtc-log-tools"
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class ResultCache:
+    """ On-disk cache of per-file partial query results. Entries are keyed on a normalized query
+    signature, the query's time window clipped to the file, and the file's identity (inode, size,
+    modification time), so files that change are transparently re-scanned. Least recently used
+    entries are evicted once the cache outgrows max_bytes.
+    """
+    directory: Path
+    max_bytes: int
+
+    def __init__(self, directory: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._size: int = None
+
+    @staticmethod
+    def key(query: dict[str, Any], file: DateRangedLogFile, start_time: datetime, end_time: datetime) -> str:
+        """ Fingerprint a query over a single file. Clipping the window to the file's time range
+        lets queries over different, but fully covering, windows share results. This relies on
+        each file's records falling between its start time and the start of the next file.
+        """
+        st = os.stat(file.path)
+        window = [max(start_time, file.start_time).isoformat(), min(end_time, file.end_time).isoformat()]
+        identity = [str(Path(file.path).resolve()), st.st_ino, st.st_size, st.st_mtime_ns]
+        signature = msgspec.json.encode({"format": CACHE_FORMAT, "query": query, "window": window, "file": identity})
+        return hashlib.sha256(signature).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> Any:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = msgspec.msgpack.decode(f.read())
+        except (FileNotFoundError, msgspec.DecodeError):
+            return None
+        # Mark the entry as recently used, unless another process has just evicted it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = msgspec.msgpack.encode(value)
+        # Write atomically, so that concurrent queries never see partial entries
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._size = (self.size() if self._size is None else self._size) + len(data)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self) -> list[os.DirEntry]:
+        if not self.directory.is_dir():
+            return []
+        return [e for d in os.scandir(self.directory) if d.is_dir() for e in os.scandir(d.path) if e.is_file()]
+
+    def size(self) -> int:
+        return sum(e.stat().st_size for e in self._entries())
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is back under 90% of its size limit """
+        entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime)
+        self._size = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            self._size -= entry.stat().st_size
+            os.unlink(entry.path)
+
+    def cached(self, query: dict[str, Any], file: DateRangedLogFile, start_time: datetime, end_time: datetime, compute: Callable[[], Any]) -> Any:
+        """ Return the cached result of a query over a file, or compute and cache it """
+        key = self.key(query, file, start_time, end_time)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
@@ -0,0 +1,178 @@
+import io
+import os
+import zlib
+import gzip
+import struct
+import msgspec
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+
+# Uncompressed size of each independently compressed block, i.e. the granularity of seeks
+BLOCK_SIZE = 256 * 1024
+# Pause in records (in seconds) at which a new block is started, so that gaps in a file's records
+# fall between blocks and can be found from the index alone (see times)
+SPLIT_GAP = 60
+INDEX_FORMAT = 1
+
+# Files are a series of gzip members, each holding a block of whole lines, followed by two empty
+# members: one carrying the block index as its comment, and a fixed-size footer carrying the
+# offset of the index member in a gzip extra field. Any gzip reader (zcat, gzip.open) sees just
+# the lines, while readers that know about the footer can jump straight to any block.
+_EMPTY_MEMBER_TRAILER = b'\x03\x00' + bytes(8)  # empty deflate stream, CRC32 and ISIZE of no data
+_COMMENT_HEADER = b'\x1f\x8b\x08\x10' + bytes(4) + b'\x00\xff'
+_FOOTER_HEADER = b'\x1f\x8b\x08\x04' + bytes(4) + b'\x00\xff' + struct.pack('<H2sH', 12, b'TI', 8)
+_FOOTER = struct.Struct(f'<{len(_FOOTER_HEADER)}sQ{len(_EMPTY_MEMBER_TRAILER)}s')
+
+
+class BlockIndex(msgspec.Struct):
+    """ Index of the blocks of a seekable gzip file. offsets and positions hold the compressed and
+    uncompressed offset of the start of each block, plus the end of the last block, and times
+    and ends hold the (epoch) time of the first and last record of each block. sources
+    identifies (by name, size and modification time) the files merged into this one, if any.
+    """
+    time_key: str
+    records: int
+    offsets: list[int]
+    positions: list[int]
+    times: list[float]
+    format: int = INDEX_FORMAT
+    sources: list[tuple[str, int, int]] = []
+    ends: list[float] = []
+
+    @property
+    def size(self) -> int:
+        return self.positions[-1]
+
+    def position_after(self, time: datetime) -> int:
+        """ The uncompressed offset of the first block starting after the given time. As records
+        are written in time order, no record before this offset is later than the given time.
+        """
+        return self.positions[bisect_right(self.times, time.timestamp())]
+
+
+class SeekableGzipWriter:
+    """ Write time-ordered lines to a seekable gzip file, compressing them in blocks of whole lines
+    and indexing each block by the times of its first and last records
+    """
+    def __init__(self, fileobj: io.BufferedIOBase, time_key: str, block_size: int = BLOCK_SIZE, compresslevel: int = 6, split_gap: float = SPLIT_GAP):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.split_gap = split_gap
+        self.index = BlockIndex(time_key, 0, [], [], [])
+        self._offset = 0
+        self._position = 0
+        self._block: list[bytes] = []
+        self._block_size = 0
+        self._last_time = None
+
+    def write(self, line: bytes, time: datetime):
+        """ Write a single line (including its newline) with the time of its record """
+        timestamp = time.timestamp()
+        if self._block and timestamp - self._last_time >= self.split_gap:
+            self._flush_block()
+        if not self._block:
+            self.index.times.append(timestamp)
+        self._last_time = timestamp
+        self._block.append(line)
+        self._block_size += len(line)
+        self.index.records += 1
+        if self._block_size >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        data = gzip.compress(b''.join(self._block), self.compresslevel, mtime=0)
+        self.index.offsets.append(self._offset)
+        self.index.positions.append(self._position)
+        self.index.ends.append(self._last_time)
+        self.fileobj.write(data)
+        self._offset += len(data)
+        self._position += self._block_size
+        self._block, self._block_size = [], 0
+
+    def close(self):
+        """ Write out the last block, then the index and footer """
+        self._flush_block()
+        self.index.offsets.append(self._offset)
+        self.index.positions.append(self._position)
+        self.fileobj.write(_COMMENT_HEADER + msgspec.json.encode(self.index) + b'\x00' + _EMPTY_MEMBER_TRAILER)
+        self.fileobj.write(_FOOTER.pack(_FOOTER_HEADER, self._offset, _EMPTY_MEMBER_TRAILER))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def read_block_index(file_path: Path) -> BlockIndex | None:
+    """ Read the block index of a seekable gzip file, or return None for any other file """
+    with open(file_path, 'rb') as f:
+        footer_offset = f.seek(0, os.SEEK_END) - _FOOTER.size
+        if footer_offset < 0:
+            return None
+        f.seek(footer_offset)
+        header, index_offset, trailer = _FOOTER.unpack(f.read(_FOOTER.size))
+        if header != _FOOTER_HEADER or trailer != _EMPTY_MEMBER_TRAILER or index_offset > footer_offset:
+            return None
+        f.seek(index_offset)
+        member = f.read(footer_offset - index_offset)
+    if not member.startswith(_COMMENT_HEADER):
+        return None
+    try:
+        return msgspec.json.decode(member[len(_COMMENT_HEADER):member.index(b'\x00', len(_COMMENT_HEADER))], type=BlockIndex)
+    except (ValueError, msgspec.DecodeError):
+        return None
+
+
+class SeekableGzipReader(io.RawIOBase):
+    """ Random-access reader of the uncompressed contents of a seekable gzip file, decompressing
+    only the blocks that are read from. Wrap in an io.BufferedReader for line-based reads.
+    """
+    def __init__(self, file_path: Path, index: BlockIndex):
+        self.index = index
+        self._file = open(file_path, 'rb')
+        self._pos = 0
+        # The most recently decompressed block, as chunked reads often straddle block boundaries
+        self._block = -1
+        self._data = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self.index.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def _load_block(self, block: int):
+        if block != self._block:
+            start, end = self.index.offsets[block], self.index.offsets[block + 1]
+            self._file.seek(start)
+            self._data = zlib.decompress(self._file.read(end - start), wbits=31)
+            self._block = block
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self.index.size:
+            return 0
+        block = bisect_right(self.index.positions, self._pos) - 1
+        self._load_block(block)
+        start = self._pos - self.index.positions[block]
+        size = min(len(buffer), len(self._data) - start)
+        buffer[:size] = self._data[start:start + size]
+        self._pos += size
+        return size
+
+    def close(self):
+        self._file.close()
+        super().close()
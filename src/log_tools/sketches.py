@@ -0,0 +1,117 @@
+import heapq
+import math
+from hashlib import blake2b
+
+
+def stable_hash(value: str) -> int:
+    """ 64-bit hash of a string that, unlike hash(), is the same across processes, so that
+    sketches built separately can be merged
+    """
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class SpaceSaving:
+    """ Bounded-memory estimate of the most frequent values in a stream (Metwally et al.'s
+    Space-Saving). At most `capacity` values are tracked; a new value evicts the least frequent
+    one and inherits its count, which is recorded as that value's maximum overestimate.
+    """
+    capacity: int
+    counts: dict[str, int]
+    errors: dict[str, int]
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # Min-heap of (count, value), lazily updated: entries may hold stale (lower) counts
+        self._heap: list[tuple[int, str]] = []
+
+    def add(self, value: str, count: int = 1):
+        if value in self.counts:
+            self.counts[value] += count
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self._evict_min()
+        self.counts[value] = error + count
+        self.errors[value] = error
+        heapq.heappush(self._heap, (self.counts[value], value))
+
+    def _evict_min(self) -> int:
+        while True:
+            count, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == count:
+                del self.counts[value]
+                del self.errors[value]
+                return count
+            if value in self.counts:
+                heapq.heappush(self._heap, (self.counts[value], value))
+
+    @property
+    def min_count(self) -> int:
+        """ Upper bound on the count of any value not being tracked """
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """ Combine two summaries (Agarwal et al.'s mergeable summaries). A value missing from a
+        full summary may have occurred up to that summary's minimum count times, which is added
+        to both its count (keeping counts upper bounds) and its error, before keeping just the
+        most frequent values.
+        """
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        self_min, other_min = self.min_count, other.min_count
+        combined = {}
+        for value in self.counts.keys() | other.counts.keys():
+            count = self.counts.get(value, self_min) + other.counts.get(value, other_min)
+            error = self.errors.get(value, self_min) + other.errors.get(value, other_min)
+            combined[value] = (count, error)
+
+        for value, (count, error) in sorted(combined.items(), key=lambda i: i[1][0], reverse=True)[:merged.capacity]:
+            merged.counts[value] = count
+            merged.errors[value] = error
+        merged._heap = [(count, value) for value, count in merged.counts.items()]
+        heapq.heapify(merged._heap)
+        return merged
+
+    def top(self, k: int) -> list[tuple[str, int, int]]:
+        """ Return up to k (value, count, max overestimate) tuples, most frequent first """
+        return [(v, c, self.errors[v]) for v, c in sorted(self.counts.items(), key=lambda i: i[1], reverse=True)[:k]]
+
+
+class HyperLogLog:
+    """ Bounded-memory estimate of the number of distinct values in a stream (Flajolet et al.),
+    using 2^precision one-byte registers. The standard error is about 1.04 / sqrt(2^precision),
+    i.e. under 1% at the default precision.
+    """
+    precision: int
+    registers: bytearray
+
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: str):
+        h = stable_hash(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost set bit in the remaining bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        if other.precision != self.precision:
+            raise ValueError("Can only merge HyperLogLog sketches of the same precision")
+        merged = HyperLogLog(self.precision)
+        merged.registers = bytearray(map(max, self.registers, other.registers))
+        return merged
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        # Small range correction, fall back to linear counting while registers are still empty
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
@@ -2,46 +2,186 @@ import typer
 from typing import Annotated
 from datetime import datetime
 import tabulate
-from collections import defaultdict, OrderedDict
+import math
+import random
+from collections import defaultdict
+from dataclasses import dataclass
 
 from . import common_args as ca
-from .file_utils import find_log_files_in_date_range, read_files_reverse
+from .file_utils import find_log_files_in_date_range, read_files_reverse, read_file_reverse, read_file_chunks, read_file_lines, file_chunk_count
 from .log_utils import safe_parse_line
 from .log_tools import DateRangedLogFile, LogFilteringConfig, FilterMode, value_matches
+from .sketches import SpaceSaving, HyperLogLog
+from .result_cache import ResultCache
 
 stats = typer.Typer()
 
+def count_file_matches(file: DateRangedLogFile, cfg: LogFilteringConfig, keys: list[tuple[str, str]]) -> tuple[list[int], bool]:
+    """ Count the in-range records of a file matching each of a set of filters, along with whether
+    the scan reached the start of the time range
+    """
+    counts = [0 for _ in keys]
+    for line in read_file_reverse(file.path, cfg.chunk_size, cfg.end_time, cfg.time_field):
+        parsed, fields = safe_parse_line(line, cfg.time_field)
+        if not parsed:
+            continue
+
+        time = fields[cfg.time_field]
+        if cfg.dt_in_range(time):
+            for i, (k, v) in enumerate(keys):
+                if value_matches(fields.get(k), v, cfg.filter_mode, cfg.fuzzy_threshold):
+                    counts[i] += 1
+
+        if cfg.done_iterating(0, time):
+            return counts, True
+    return counts, False
+
 def tabluate_log_matches(files: list[DateRangedLogFile], cfg: LogFilteringConfig):
-    # Queue to hold lines ahead of/behind matches for printing
-    matched_lines = 0
+    non_partition_keys = [(k, v) for k,v in cfg.filter_list if k != cfg.partition_key]
+    query = cfg.query_signature("stats", non_partition_keys)
 
+    totals = [0 for _ in non_partition_keys]
+    for file in files:
+        if cfg.cache is not None:
+            counts, done = cfg.cache.cached(query, file, cfg.start_time, cfg.end_time, lambda: count_file_matches(file, cfg, non_partition_keys))
+        else:
+            counts, done = count_file_matches(file, cfg, non_partition_keys)
+        totals = [t + c for t, c in zip(totals, counts)]
+        if done:
+            break
+
+    rows = [[files[0].first_record.get(cfg.partition_key), *(c or '' for c in totals)]]
+    
+    headers = [cfg.partition_key, *[v if k == cfg.msg_field else f"{k}={v}" for k,v in non_partition_keys]]
+
+    return rows, headers
+
+# z-score of a two-sided 95% confidence interval
+Z_95 = 1.96
+
+def estimate_total(unit_counts: list[int], population: int) -> tuple[float, float]:
+    """ Estimate a population total from the counts in a simple random sample of its units,
+    returning the estimate along with the half-width of its 95% confidence interval
+    """
+    n = len(unit_counts)
+    mean = sum(unit_counts) / n
+    if n == population:
+        return sum(unit_counts), 0.0
+    if n < 2:
+        return population * mean, math.inf
+    variance = sum((c - mean) ** 2 for c in unit_counts) / (n - 1)
+    return population * mean, Z_95 * population * math.sqrt((1 - n / population) * variance / n)
+
+def format_estimate(estimate: tuple[float, float]) -> str:
+    total, half_width = estimate
+    return f"{total:.0f} ± {half_width:.0f}" if total or half_width else ''
+
+def estimate_log_matches(files: list[DateRangedLogFile], cfg: LogFilteringConfig, rate: float, rng: random.Random):
+    """ Like tabluate_log_matches, but only reads a random sample of the chunks making up
+    a partition's files, scaling the counts in those chunks up to estimates of the totals.
+    Compressed files that can't be seeked into (i.e. other than compacted ones) are sampled
+    as a whole, as reading any chunk of them means decompressing everything before it.
+    """
     non_partition_keys = [(k, v) for k,v in cfg.filter_list if k != cfg.partition_key]
-    filter_counts: dict[str, dict[tuple[str,str], int]] = {
-        files[0].first_record.get(cfg.partition_key): OrderedDict([
-            [(k, v), 0] for k, v in non_partition_keys])
-    }
 
-    for line in read_files_reverse(files, cfg.chunk_size):
+    # Sampling units are (path, chunk index) pairs, with an index of None for a whole file
+    units: list[tuple[str, int | None]] = []
+    for file in files:
+        if (chunks := file_chunk_count(file.path, cfg.chunk_size)) is None:
+            units.append((file.path, None))
+        else:
+            units.extend((file.path, index) for index in range(chunks))
+    sample = rng.sample(units, max(1, math.ceil(rate * len(units))))
+    sampled_chunks: dict[str, list[int | None]] = defaultdict(list)
+    for path, index in sample:
+        sampled_chunks[path].append(index)
+
+    unit_counts: dict[tuple[str, str], list[int]] = {kv: [] for kv in non_partition_keys}
+    for path, indexes in sampled_chunks.items():
+        sampled_lines = [read_file_lines(path)] if indexes == [None] else read_file_chunks(path, sorted(indexes), cfg.chunk_size)
+        for lines in sampled_lines:
+            chunk_counts = dict.fromkeys(non_partition_keys, 0)
+            for line in lines:
+                parsed, fields = safe_parse_line(line, cfg.time_field)
+                if not parsed or not cfg.dt_in_range(fields[cfg.time_field]):
+                    continue
+                for k, v in non_partition_keys:
+                    if value_matches(fields.get(k), v, cfg.filter_mode, cfg.fuzzy_threshold):
+                        chunk_counts[(k, v)] += 1
+            for kv, count in chunk_counts.items():
+                unit_counts[kv].append(count)
+
+    rows = [[files[0].first_record.get(cfg.partition_key), *(format_estimate(estimate_total(c, len(units))) for c in unit_counts.values())]]
+    headers = [cfg.partition_key, *[v if k == cfg.msg_field else f"{k}={v}" for k,v in non_partition_keys]]
+
+    return rows, headers, len(sample), len(units)
+
+# Number of values tracked by each top-k sketch, per value shown
+TOP_CAPACITY_FACTOR = 100
+
+@dataclass
+class FieldSketches:
+    """ Mergeable, bounded-memory summaries of the values of a set of fields: the most
+    frequent values for --top fields, and the number of distinct values for --distinct fields
+    """
+    top: dict[str, SpaceSaving]
+    distinct: dict[str, HyperLogLog]
+
+    @classmethod
+    def for_fields(cls, top_fields: list[str], distinct_fields: list[str], capacity: int) -> "FieldSketches":
+        return cls({f: SpaceSaving(capacity) for f in top_fields}, {f: HyperLogLog() for f in distinct_fields})
+
+    def add(self, fields: dict):
+        for field, sketch in self.top.items():
+            if (value := fields.get(field)) is not None:
+                sketch.add(str(value))
+        for field, sketch in self.distinct.items():
+            if (value := fields.get(field)) is not None:
+                sketch.add(str(value))
+
+    def merge(self, other: "FieldSketches") -> "FieldSketches":
+        return FieldSketches(
+            {f: s.merge(other.top[f]) for f, s in self.top.items()},
+            {f: s.merge(other.distinct[f]) for f, s in self.distinct.items()})
+
+def sketch_log_fields(files: list[DateRangedLogFile], cfg: LogFilteringConfig, sketches: FieldSketches):
+    """ Add the fields of every in-range record matching the (non-partition) filters to a set of sketches """
+    non_partition_keys = [(k, v) for k,v in cfg.filter_list if k != cfg.partition_key]
+
+    for line in read_files_reverse(files, cfg.chunk_size, cfg.end_time, cfg.time_field):
         parsed, fields = safe_parse_line(line, cfg.time_field)
         if not parsed:
             continue
-        for k, v in non_partition_keys:
-            if value_matches(fields.get(k), v, cfg.filter_mode):
-                filter_counts[fields.get(cfg.partition_key)][(k, v)] += 1
 
+        time = fields[cfg.time_field]
+        if cfg.dt_in_range(time) and all(value_matches(fields.get(k), v, cfg.filter_mode, cfg.fuzzy_threshold) for k, v in non_partition_keys):
+            sketches.add(fields)
 
-        if cfg.done_iterating(matched_lines, fields[cfg.time_field]):
+        if cfg.done_iterating(0, time):
             break
 
+def print_field_sketches(partition_sketches: dict[str, FieldSketches], partition_key: str, top_k: int):
+    # Summarize across all partitions as well, when there's more than one
+    if len(partition_sketches) > 1:
+        sketches = list(partition_sketches.values())
+        total = sketches[0]
+        for s in sketches[1:]:
+            total = total.merge(s)
+        partition_sketches = {**partition_sketches, "(all)": total}
 
-    rows = [[k, *(c or '' for c in v.values())] for k, v in filter_counts.items()]
-    
-    headers = [cfg.partition_key, *[v if k == cfg.msg_field else f"{k}={v}" for k,v in non_partition_keys]]
-
-    return rows, headers
+    top_rows = [[partition, field, value, count, error or '']
+                for partition, sketches in partition_sketches.items()
+                for field, sketch in sketches.top.items()
+                for value, count, error in sketch.top(top_k)]
+    if top_rows:
+        print(tabulate.tabulate(top_rows, headers=[partition_key, "Field", "Value", "Count", "Max Overcount"],
+                                tablefmt='rounded_outline', maxcolwidths=[None, None, 60, None, None]))
 
-    
-    # print(tabulate.tabulate(rows, headers=headers))
+    distinct_rows = [[partition, field, sketch.count()]
+                     for partition, sketches in partition_sketches.items()
+                     for field, sketch in sketches.distinct.items()]
+    if distinct_rows:
+        print(tabulate.tabulate(distinct_rows, headers=[partition_key, "Field", "Distinct Values (approx.)"], tablefmt='rounded_outline'))
 
 @stats.callback(invoke_without_command=True)
 def get_filter_match_stats(
@@ -58,9 +198,22 @@ def get_filter_match_stats(
         partition_key: ca.PartitionKeyArg = "",
         filters: Annotated[list[str], typer.Option("-f", "--filters", help="Key-Value pairs that should appear in the logs")] = [],
         filter_mode: Annotated[FilterMode, typer.Option("-m", "--filter-mode", help="String comparison mode to use for filtering logs")] = FilterMode.RAW.value,
+        fuzzy_threshold: ca.FuzzyThresholdArg = ca.FUZZY_THRESHOLD,
+        top: Annotated[list[str], typer.Option("--top", help="Fields for which to report the most frequent values")] = [],
+        distinct: Annotated[list[str], typer.Option("--distinct", help="Fields for which to report the (approximate) number of distinct values")] = [],
+        top_k: Annotated[int, typer.Option("--top-k", help="Number of most frequent values to report per field")] = 10,
+        sample: Annotated[float, typer.Option("--sample", min=0, max=1, help="Estimate counts from this fraction of each partition's file chunks (or whole files, for compressed files)")] = 0,
+        seed: Annotated[int, typer.Option(help="Random seed for --sample, for reproducible estimates")] = None,
+        cache: ca.CacheArg = False,
 ):
-    """ Tabulate the count of matching filters in log messages across a partition key
+    """ Tabulate the count of matching filters in log messages across a partition key. With
+    --top or --distinct, instead summarize the values of the given fields in messages matching
+    the filters. With --sample, estimate counts (with 95% confidence intervals) from a random
+    sample of --chunk-size chunks of each partition's files, or of whole files for compressed
+    files other than compacted ones.
     """
+    if sample and (top or distinct):
+        raise typer.BadParameter("--sample only applies to filter counts, not --top or --distinct")
 
     filter_config = LogFilteringConfig(
         start_date, 
@@ -74,10 +227,15 @@ def get_filter_match_stats(
         exclude_keys, 
         partition_key, 
         filters, 
-        filter_mode)
+        filter_mode,
+        fuzzy_threshold=fuzzy_threshold,
+        cache=ResultCache() if cache else None)
 
     all_rows = []
     headers = []
+    partition_sketches: dict[str, FieldSketches] = {}
+    rng = random.Random(seed)
+    sampled_chunks = total_chunks = 0
     # Glob plain and compressed files from the input directory
     for _, files in find_log_files_in_date_range(log_path, filter_config.start_time, filter_config.end_time, time_field, partition_key):
         
@@ -85,11 +243,27 @@ def get_filter_match_stats(
         # match a filter
         fields = files[0].first_record
         partition_filters = [v for k, v in filter_config.filter_list if k == partition_key]
-        if not all(value_matches(fields.get(partition_key), v, filter_mode) for v in partition_filters):
+        if not all(value_matches(fields.get(partition_key), v, filter_mode, fuzzy_threshold) for v in partition_filters):
             continue
 
-        rows, headers = tabluate_log_matches(files, filter_config)
+        if top or distinct:
+            sketches = partition_sketches.setdefault(fields.get(filter_config.partition_key), FieldSketches.for_fields(top, distinct, top_k * TOP_CAPACITY_FACTOR))
+            sketch_log_fields(files, filter_config, sketches)
+            continue
+
+        if sample:
+            rows, headers, sampled, total = estimate_log_matches(files, filter_config, sample, rng)
+            sampled_chunks += sampled
+            total_chunks += total
+        else:
+            rows, headers = tabluate_log_matches(files, filter_config)
         all_rows += rows
 
+    if top or distinct:
+        print_field_sketches(partition_sketches, partition_key, top_k)
+        return
+
     colaign = ('left', *('right' for _ in headers[1:]))
     print(tabulate.tabulate(all_rows, headers=headers, tablefmt='rounded_outline', colalign=colaign))
+    if sample:
+        print(f"Estimated from {sampled_chunks} of {total_chunks} chunks (or whole compressed files), ± gives 95% confidence intervals")